@@ -1,13 +1,5 @@
-import json
-from json import JSONEncoder
-from base64 import urlsafe_b64encode
-from copy import copy
-from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from datetime import datetime as dt
-from pwmdata import Account, DecodeDateTime, DateTimeEncoder
-import datetime
+import sys
+from pwmdata import readVault, serializeAccount
 
 FILE_NAME_A = 'accounts.data'
 FILE_NAME_B = 'accountsfromphone.data'
@@ -15,19 +7,10 @@ OUTPUT_FILE_NAME = 'compare.result'
 
 # return dic of Accounts
 def load(filename, password):
-  with open(filename, 'rb') as inputFile:
-    accounts = {}
-    encrypted = inputFile.read()
-    # decrypt file based on self.masterPassword
-    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=b'69420', iterations=69420)
-    key = urlsafe_b64encode(kdf.derive(bytes(password, 'utf-8')))
-    fernet = Fernet(key)
-    decrypted = fernet.decrypt(encrypted)
-
-    for line in decrypted.splitlines():
-      acc = Account(**json.loads(str(line, 'utf-8'), object_hook=DecodeDateTime))
-      accounts[acc.accountName] = acc
-    return accounts
+  accounts = {}
+  for acc in readVault(filename, password):
+    accounts[acc.accountName] = acc
+  return accounts
 
 def compare(a, b):
   exclusiveA = [] # accounts in A but not in B
@@ -49,29 +32,29 @@ def compare(a, b):
     json_string = ''
     json_string += f'{len(exclusiveA)} accounts exclusive to file {FILE_NAME_A}\n'
     for acc in exclusiveA:
-      json_string += json.dumps(acc.__dict__, cls=DateTimeEncoder) + '\n'
+      json_string += serializeAccount(acc)
     
     json_string += '\n'
 
     json_string += f'{len(exclusiveB)} accounts exclusive to file {FILE_NAME_B}\n'
     for acc in exclusiveB:
-      json_string += json.dumps(acc.__dict__, cls=DateTimeEncoder) + '\n'
+      json_string += serializeAccount(acc)
 
     json_string += '\n'
 
     json_string += f'{len(newerInA)} accounts newer in {FILE_NAME_A}\n'
     for pair in newerInA:
       accA, accB = pair[0], pair[1]
-      json_string += '\t' + json.dumps(accA.__dict__, cls=DateTimeEncoder) + '\n'
-      json_string += '\t' + json.dumps(accB.__dict__, cls=DateTimeEncoder) + '\n'
+      json_string += '\t' + serializeAccount(accA)
+      json_string += '\t' + serializeAccount(accB)
 
     json_string += '\n'
 
     json_string += f'{len(newerInB)} accounts newer in {FILE_NAME_B}\n'
     for pair in newerInB:
       accA, accB = pair[0], pair[1]
-      json_string += '\t' + json.dumps(accA.__dict__, cls=DateTimeEncoder) + '\n'
-      json_string += '\t' + json.dumps(accB.__dict__, cls=DateTimeEncoder) + '\n'
+      json_string += '\t' + serializeAccount(accA)
+      json_string += '\t' + serializeAccount(accB)
 
     json_string += '\n'
 
@@ -79,6 +62,9 @@ def compare(a, b):
 
 
 if __name__ == '__main__':
+  # file names can be given as arguments: python diffacc.py fileA fileB
+  if len(sys.argv) == 3:
+    FILE_NAME_A, FILE_NAME_B = sys.argv[1], sys.argv[2]
   a = load(FILE_NAME_A, input("Password for File A:"))
   b = load(FILE_NAME_B, input("Password for File B:"))
   compare(a, b)
@@ -1,7 +1,9 @@
+import sys
 from getpass import getpass
 from types import FunctionType, MethodType
-from pwmdata import Database, Account, EmptyInputException
+from pwmdata import Database, Account, EmptyInputException, calibrateKdf
 from cryptography.fernet import InvalidToken
+from datetime import datetime as dt
 
 ### High level view:
 # States are used to facilitate going 'back' to the previous step. User input = '`'
@@ -132,9 +134,18 @@ class Manager:
   def fo_home(self):
     self.popStackUntil(1)
 
+  # input keeps being read while saves are written in the background.
+  # Changes other programs make to the vault files are merged in before showing the next state
   def run(self):
-    while len(self.stateStack) > 0:
-      self.readStack()
+    self.data.watch()
+    try:
+      while len(self.stateStack) > 0:
+        for name in self.data.refreshChanged():
+          printn(f'Vault {name} was changed by another program, its changes were merged in')
+        self.readStack()
+    finally:
+      # make sure the last save reaches the disk before exiting
+      self.data.close()
 
   # creating the state tree from root to branches
   def initialization(self):
@@ -146,10 +157,16 @@ class Manager:
     st_addAccount.addOption(Option('Account name: ', self.fo_addAccount))
     st_deleteAccount = State('Deleting account')
     st_searchByAccountName = State('Search by Account Name')
+    st_searchEverything = State('Search everything\nWords must all match, "OR" between alternatives, "*" after a word matches its start')
+    st_searchEverything.addOption(Option('Enter words to search: ', self.fo_searchEverything))
     st_checkMasterPassword = State('Changing Master Password\nYou can backtrack this process with "`"')
     st_checkMasterPassword.addOption(Option('Enter current master password: ', self.fo_checkMasterPassword, passwordInput=True))
+    st_restoreVault = State('Restoring all accounts to an earlier time')
+    st_restoreVault.addOption(Option('Time (YYYY-MM-DD HH:MM): ', self.fo_restoreVault))
     
     st_home.addOption(Option('Search by Name', self.fog_nextState(st_searchByAccountName)))
+    st_home.addOption(Option('Browse A-Z', self.fo_getLetterList))
+    st_home.addOption(Option('Search Everything', self.fog_nextState(st_searchEverything)))
     st_home.addOption(Option('Add New Account', self.fog_nextState(st_addAccount)))
     st_home.addOption(Option('Search by Email', self.fo_getEmailList))
     st_home.addOption(Option('Search by Username', self.fo_getUsernameList))
@@ -157,21 +174,32 @@ class Manager:
     st_home.addOption(Option('Search by Phone Number', self.fo_getPhoneList))
     st_home.addOption(Option('Search by Linked Account', self.fo_getlinkedAccountsList))
     st_home.addOption(Option('Change Master Password', self.fog_nextState(st_checkMasterPassword)))
+    st_home.addOption(Option('Restore Vault to Time', self.fog_nextState(st_restoreVault)))
     # st_home.addOption(Option('Delete Account Entry', self.fog_nextState(st_deleteAccount))) TODO
 
     opt_inputKeyword = Option('Enter keyword to search:', self.fo_searchByAccountName)
     st_searchByAccountName.addOption(opt_inputKeyword)
 
     try:
-      password = getpass("Please enter your password: ")
-      self.data.load(password)
+      vaults = self.data.vaults
+      if len(vaults) > 1:
+        passwords = {v.fileName: getpass(f'Please enter your password for {v.name}: ') for v in vaults}
+        self.data.unlock(passwords)
+      else:
+        password = getpass("Please enter your password: ")
+        self.data.load(password)
     except InvalidToken:
       print('The password you have entered is invalid')
       self.popStackUntil(0)
-    except FileNotFoundError:
-      print(f'Data file {self.data.DATA_FILE_NAME} does not exist. \n' + \
+    except FileNotFoundError as e:
+      print(f'Data file {e.filename} does not exist. \n' + \
         'It seems like this is your first time using the program.')
-      self.masterPassword = input("Please setup a password: ")
+      # unlock only raises this if every vault file is missing, each is new and needs its own password
+      if len(self.data.vaults) > 1:
+        for v in self.data.vaults:
+          v.masterPassword = input(f'Please setup a password for {v.name}: ')
+      else:
+        self.data.masterPassword = input("Please setup a password: ")
 
 
   # function object that checks current master password for authentication
@@ -196,8 +224,8 @@ class Manager:
   def fog_confirmNewMasterPassword(self, password):
     def outputfunc(text):    
       if text == password:
-        data.updateMasterPassword(password)
-        print('Master password updated')
+        if data.updateMasterPassword(password):
+          print('Master password updated')
       else:
         print('password entered does not match')
       # back to home state regardless of match
@@ -210,16 +238,44 @@ class Manager:
     accountList = data.filterAccountsByAccountName(text)
     st_filtered = State(f'There are {len(accountList)} matches')
     for acc in accountList:
-      st_filtered.addOption(Option(acc.accountName, self.fog_focusAccount(acc), textInput=False))
+      st_filtered.addOption(Option(self.accountLabel(acc), self.fog_focusAccount(acc), textInput=False))
+    self.pushStack(st_filtered)
+
+  # function object that searches misc fields and all other account details except passwords
+  # returns next state containing list of accounts matched
+  def fo_searchEverything(self, text):
+    accountList = data.searchEverything(text)
+    st_filtered = State(f'There are {len(accountList)} matches')
+    for acc in accountList:
+      st_filtered.addOption(Option(self.accountLabel(acc), self.fog_focusAccount(acc), textInput=False))
     self.pushStack(st_filtered)
 
+  # returns next state containing list of accounts starting with the letter
+  def fog_getAccountsWithLetter(self, letter):
+    def outputfunc():
+      accountList = data.filterAccountsByLetter(letter)
+      st_filtered = State(f'There are {len(accountList)} accounts under {letter}')
+      for acc in accountList:
+        st_filtered.addOption(Option(self.accountLabel(acc), self.fog_focusAccount(acc), textInput=False))
+      self.pushStack(st_filtered)
+    return outputfunc
+
+  # function object that shows the letters accounts start with, to jump to
+  def fo_getLetterList(self):
+    st_letterList = State('Jump to:')
+    for letter in [chr(c) for c in range(ord('A'), ord('Z') + 1)] + ['#']:
+      count = data.countAccountsByLetter(letter)
+      if count > 0:
+        st_letterList.addOption(Option(f'{letter} ({count})', self.fog_getAccountsWithLetter(letter), textInput=False))
+    self.pushStack(st_letterList)
+
   # returns next state containing list of accounts filtered by email
   def fog_getAccountsWithEmail(self, email):
     def outputfunc():
       accountList = data.filterAccountsByEmail(email)
       st_filtered = State(f'There are {len(accountList)} matches')
       for acc in accountList:
-        st_filtered.addOption(Option(acc.accountName, self.fog_focusAccount(acc), textInput=False))
+        st_filtered.addOption(Option(self.accountLabel(acc), self.fog_focusAccount(acc), textInput=False))
       self.pushStack(st_filtered)
     return outputfunc
 
@@ -236,7 +292,7 @@ class Manager:
       accountList = data.filterAccountsByUsername(username)
       st_filtered = State(f'There are {len(accountList)} matches')
       for acc in accountList:
-        st_filtered.addOption(Option(acc.accountName, self.fog_focusAccount(acc), textInput=False))
+        st_filtered.addOption(Option(self.accountLabel(acc), self.fog_focusAccount(acc), textInput=False))
       self.pushStack(st_filtered)
     return outputfunc
 
@@ -253,7 +309,7 @@ class Manager:
       accountList = data.filterAccountsByPassword(password)
       st_filtered = State(f'There are {len(accountList)} matches')
       for acc in accountList:
-        st_filtered.addOption(Option(acc.accountName, self.fog_focusAccount(acc), textInput=False))
+        st_filtered.addOption(Option(self.accountLabel(acc), self.fog_focusAccount(acc), textInput=False))
       self.pushStack(st_filtered)
     return outputfunc
 
@@ -270,7 +326,7 @@ class Manager:
       accountList = data.filterAccountsByPhone(phone)
       st_filtered = State(f'There are {len(accountList)} matches')
       for acc in accountList:
-        st_filtered.addOption(Option(acc.accountName, self.fog_focusAccount(acc), textInput=False))
+        st_filtered.addOption(Option(self.accountLabel(acc), self.fog_focusAccount(acc), textInput=False))
       self.pushStack(st_filtered)
     return outputfunc
 
@@ -287,7 +343,7 @@ class Manager:
       accountList = data.filterAccountsByLinkedAccounts(accountName)
       st_filtered = State(f'There are {len(accountList)} matches')
       for acc in accountList:
-        st_filtered.addOption(Option(acc.accountName, self.fog_focusAccount(acc), textInput=False))
+        st_filtered.addOption(Option(self.accountLabel(acc), self.fog_focusAccount(acc), textInput=False))
       self.pushStack(st_filtered)
     return outputfunc
 
@@ -337,9 +393,15 @@ class Manager:
       return self.fog_focusAccount(updatedAccount)()
     return outputfunc
 
+  # account name tagged with its vault when more than one vault is mounted
+  def accountLabel(self, account: type[Account]):
+    if len(self.data.vaults) > 1:
+      return f'{account.accountName} [{account.vault.name}]'
+    return account.accountName
+
   def stringifyAccount(self, account: type[Account]):
     return \
-      f'Account    : {account.accountName}\n'+ \
+      f'Account    : {self.accountLabel(account)}\n'+ \
       f'last edited: {account.lastEdited.isoformat(sep=' ', timespec='seconds')}\n' + \
       f'username   : {account.username}\n' + \
       f'email      : {account.email}\n' + \
@@ -386,6 +448,9 @@ class Manager:
       st_editMisc = State(f'What field to edit / delete? (adds if not existent)')
       st_editMisc.addOption(Option('Field name: ', self.fog_chooseField(account)))
 
+      st_restoreAccount = State(f'Restoring {account.accountName} to an earlier time')
+      st_restoreAccount.addOption(Option('Time (YYYY-MM-DD HH:MM): ', self.fog_restoreAccount(account)))
+
       st_deleteConfirmation = State(f'Are you sure you want to delete the account for {account.accountName}')
       st_deleteConfirmation.addOption(Option('1 = YES \\ enter = NO: ', self.fog_deleteAccount(account)))
 
@@ -396,6 +461,7 @@ class Manager:
       st_viewAccount.addOption(Option('Edit Phone Number', self.fog_nextState(st_editPhone)))
       st_viewAccount.addOption(Option('Edit LinkedAccounts', self.fog_nextState(st_editLinkeAccounts)))
       st_viewAccount.addOption(Option('Edit Misc info', self.fog_nextState(st_editMisc)))
+      st_viewAccount.addOption(Option('Restore to Time', self.fog_nextState(st_restoreAccount)))
       st_viewAccount.addOption(Option('Delete Account', self.fog_nextState(st_deleteConfirmation)))
       st_viewAccount.addOption(Option('Exit', self.fo_home))
       self.pushStack(st_viewAccount)
@@ -414,6 +480,26 @@ class Manager:
     else:
       print(f'Account with name "{text}" already exists')
 
+  # returns a function object that restores the account to the time entered
+  def fog_restoreAccount(self, account):
+    def outputfunc(text):
+      time = parseTime(text)
+      if time is None:
+        return
+      updatedAccount = data.restoreAccount(account, time)
+      self.popStack(2)
+      return self.fog_focusAccount(updatedAccount)()
+    return outputfunc
+
+  # function object that restores all accounts of the default vault to the time entered
+  def fo_restoreVault(self, text):
+    time = parseTime(text)
+    if time is None:
+      return
+    data.restoreVault(time)
+    print(f'Vault {data.defaultVault().name} restored to {time}')
+    self.fo_home()
+
   # returns a function object that takes 1 as input confirmation to delete selected acc
   def fog_deleteAccount(self, acc):
     def outputfunc(input):
@@ -479,13 +565,40 @@ class Option:
 def printn(text):
   print(f'\n{text}')
 
+# returns the datetime of an ISO formatted text, None if the format is wrong
+def parseTime(text):
+  try:
+    return dt.fromisoformat(text)
+  except ValueError:
+    print(f'Time entered {text} is not of format YYYY-MM-DD HH:MM')
+    return None
+
 ### end of UTIL Functions
 
 if __name__ == '__main__':
 
   # Init Options and States
+  # python pwm.py --calibrate [target unlock time in ms] [pbkdf2-sha256/scrypt]
+  # picks key derivation parameters for this machine, vaults are re-keyed on their next save
+  if sys.argv[1:2] == ['--calibrate']:
+    targetMs = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+    kdf = sys.argv[3] if len(sys.argv) > 3 else 'pbkdf2-sha256'
+    print(f'Calibrated key derivation: {calibrateKdf(targetMs / 1000, kdf)}')
+    sys.exit()
+
   print('Password Manager running...')
   data = Database()
+  # python pwm.py [--compression zlib/lzma/none] [vault files]
+  # vault files default to accounts.data. Compression applies to saving, files open with any
+  args = sys.argv[1:]
+  if args[:1] == ['--compression']:
+    if len(args) < 2 or args[1] not in ['zlib', 'lzma', 'none']:
+      print('--compression takes zlib, lzma or none')
+      sys.exit(1)
+    data.COMPRESSION = None if args[1] == 'none' else args[1]
+    args = args[2:]
+  for fileName in args:
+    data.mount(fileName)
   manager = Manager(data)
   manager.initialization()
   manager.run()
@@ -1,12 +1,24 @@
+import hashlib
 import json
+import lzma
+import zlib
 from json import JSONEncoder
-from base64 import urlsafe_b64encode
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from copy import copy
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 from datetime import datetime as dt
 import datetime
+import os
+import shutil
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from pwmhistory import History
+from pwmindex import SearchIndex
 
 ### this version is to be used together with pwm.py
 # It is repurposed to serve as the data module, abstracts away data operations and removes UX operations
@@ -19,9 +31,22 @@ class Account():
     self.password = password
     self.phone = phone
     self.linkedAccounts = linkedAccounts
-    self.misc = misc
+    self.misc = normalizeMisc(misc)
     self.lastEdited = lastEdited
+    self.vault = None # Vault the account is stored in, not saved to file
 
+# converts from previous data implementation where mutli-line misc items are in lists.
+# Changes misc in place and returns it
+def normalizeMisc(misc):
+  for k, v in misc.items():
+    if isinstance(v, list):
+      misc[k] = "".join(v)
+  return misc
+
+# returns the json line of an account as it is stored in the data file
+def serializeAccount(account):
+  fields = {k: v for k, v in account.__dict__.items() if k != 'vault'}
+  return json.dumps(fields, cls=DateTimeEncoder) + '\n'
 
 class DateTimeEncoder(JSONEncoder):
         #Override the default method
@@ -39,73 +64,764 @@ class EmptyInputException(Exception):
   def __init__(self) -> None:
       super().__init__()
 
+### Key derivation
+# A vault file starts with a header line recording how its key is derived:
+#   PWM {"kdf": "pbkdf2-sha256", "iterations": 69420, "salt": "<urlsafe base64>"}
+# followed by the fernet token. Files without a header are from before headers existed
+# and use LEGACY_KDF, they get a header with a random salt on their next save.
+# The parameters new keys are made with are read from KDF_CONFIG_FILE_NAME, written by calibrateKdf
+HEADER_PREFIX = b'PWM '
+KDF_CONFIG_FILE_NAME = 'kdf.config'
+SALT_BYTES = 16
+LEGACY_KDF = {'kdf': 'pbkdf2-sha256', 'iterations': 69420, 'salt': str(urlsafe_b64encode(b'69420'), 'ascii')}
+DEFAULT_KDF = {'kdf': 'pbkdf2-sha256', 'iterations': 69420}
+
+# derives the fernet key from the master password
+def deriveKey(password, kdfParams):
+  salt = urlsafe_b64decode(kdfParams['salt'])
+  if kdfParams['kdf'] == 'pbkdf2-sha256':
+    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=kdfParams['iterations'])
+  elif kdfParams['kdf'] == 'scrypt':
+    kdf = Scrypt(salt=salt, length=32, n=kdfParams['n'], r=kdfParams['r'], p=kdfParams['p'])
+  else:
+    raise ValueError(f'Unknown key derivation function {kdfParams["kdf"]}')
+  return urlsafe_b64encode(kdf.derive(bytes(password, 'utf-8')))
+
+# returns the kdf parameters new keys should be made with, without salt
+def loadKdfConfig():
+  try:
+    with open(KDF_CONFIG_FILE_NAME, 'r') as inputFile:
+      return json.load(inputFile)
+  except FileNotFoundError:
+    return dict(DEFAULT_KDF)
+
+# returns the given kdf parameters with a new random salt
+def saltKdf(kdfParams):
+  return {**kdfParams, 'salt': str(urlsafe_b64encode(os.urandom(SALT_BYTES)), 'ascii')}
+
+# true if keys made with kdfParams should be remade with the configured parameters
+def needsRekey(kdfParams, configured):
+  if kdfParams is None or kdfParams['salt'] == LEGACY_KDF['salt']:
+    return True
+  return {k: v for k, v in kdfParams.items() if k != 'salt'} != configured
+
+# splits the contents of a vault file into its kdf parameters, compression and fernet token
+def parseVaultFile(content):
+  if not content.startswith(HEADER_PREFIX):
+    return dict(LEGACY_KDF), None, content
+  header, token = content.split(b'\n', 1)
+  kdfParams = json.loads(header[len(HEADER_PREFIX):])
+  compression = kdfParams.pop('compression', None)
+  # binary tokens are stored without fernet's base64 encoding
+  if kdfParams.pop('token', None) == 'binary':
+    token = urlsafe_b64encode(token)
+  return kdfParams, compression, token
+
+def vaultHeader(kdfParams, compression):
+  header = dict(kdfParams)
+  if compression is not None:
+    header.update({'compression': compression, 'token': 'binary'})
+  return HEADER_PREFIX + bytes(json.dumps(header), 'ascii') + b'\n'
+
+### Compression
+# The account lines can be compressed before encryption, recorded by the 'compression' header field.
+# 'zlib' is primed with ZLIB_DICTIONARY, the text repeated in every account line.
+# Files depend on the exact dictionary bytes, so it must never change. 'lzma' has no preset dictionary.
+# Fernet only encrypts and decrypts whole messages, so a save holds the lines and the compressed payload,
+# and a load holds the decrypted payload and the lines. Working line by line only avoids also joining the lines
+ZLIB_DICTIONARY = b'"misc": {}, "lastEdited": "20", "linkedAccounts": [], "phone": "", "password": "", ' + \
+  b'"email": "@gmail.com", "username": "", {"accountName": "'
+COMPRESSION_CHUNK = 64 * 1024
+
+def compressor(compression):
+  if compression == 'zlib':
+    return zlib.compressobj(zdict=ZLIB_DICTIONARY)
+  if compression == 'lzma':
+    return lzma.LZMACompressor()
+  raise ValueError(f'Unknown compression {compression}')
+
+def decompressor(compression):
+  if compression == 'zlib':
+    return zlib.decompressobj(zdict=ZLIB_DICTIONARY)
+  if compression == 'lzma':
+    return lzma.LZMADecompressor()
+  raise ValueError(f'Unknown compression {compression}')
+
+# returns the bytes to encrypt from a list of account lines
+def packLines(lines, compression):
+  if compression is None:
+    return bytes(''.join(lines), 'ascii')
+  comp = compressor(compression)
+  chunks = [comp.compress(bytes(line, 'ascii')) for line in lines]
+  chunks.append(comp.flush())
+  return b''.join(chunks)
+
+# yields the account lines of decrypted bytes, without the trailing newline
+def unpackLines(payload, compression):
+  if compression is None:
+    yield from payload.splitlines()
+    return
+  decomp = decompressor(compression)
+  rest = b''
+  for start in range(0, len(payload), COMPRESSION_CHUNK):
+    rest += decomp.decompress(payload[start:start + COMPRESSION_CHUNK])
+    *lines, rest = rest.split(b'\n')
+    yield from lines
+  if rest:
+    yield rest
+
+# decrypts a vault file and returns its accounts, without locking the file or reading its history.
+# For read-only tools like diffacc.py
+def readVault(fileName, password):
+  with open(fileName, 'rb') as inputFile:
+    content = inputFile.read()
+  kdfParams, compression, encrypted = parseVaultFile(content)
+  decrypted = Fernet(deriveKey(password, kdfParams)).decrypt(encrypted)
+  return [Account(**json.loads(line, object_hook=DecodeDateTime)) for line in unpackLines(decrypted, compression)]
+
+# benchmarks the host and writes kdf parameters that take about targetSeconds to derive a key.
+# pbkdf2-sha256 scales its iterations, scrypt doubles its cost n. Returns the parameters
+def calibrateKdf(targetSeconds=0.25, kdf='pbkdf2-sha256'):
+  def timeDerive(kdfParams):
+    start = time.perf_counter()
+    deriveKey('calibration', saltKdf(kdfParams))
+    return time.perf_counter() - start
+
+  if kdf == 'pbkdf2-sha256':
+    sample = {'kdf': kdf, 'iterations': 50000}
+    elapsed = min(timeDerive(sample) for _ in range(3))
+    iterations = int(sample['iterations'] * targetSeconds / elapsed) // 1000 * 1000
+    kdfParams = {'kdf': kdf, 'iterations': max(iterations, DEFAULT_KDF['iterations'])}
+  elif kdf == 'scrypt':
+    kdfParams = {'kdf': kdf, 'n': 2 ** 14, 'r': 8, 'p': 1}
+    while timeDerive({**kdfParams, 'n': kdfParams['n'] * 2}) <= targetSeconds:
+      kdfParams['n'] *= 2
+  else:
+    raise ValueError(f'Unknown key derivation function {kdf}')
+
+  with open(KDF_CONFIG_FILE_NAME, 'w') as outputFile:
+    json.dump(kdfParams, outputFile)
+  return kdfParams
+
+### Concurrent writers
+# Other programs (another pwm.py session, a sync tool) may replace a vault file while it is open.
+# Writes happen while holding an advisory lock on <file>.lock, and before writing the file is
+# compared with the version last read or written. If it changed, both versions are merged by
+# account name, keeping the more recently edited account, instead of overwriting the other changes
+if os.name == 'nt':
+  import msvcrt
+else:
+  import fcntl
+
+class FileLock():
+  def __init__(self, fileName):
+    self.fileName = fileName
+    self.threadLock = threading.Lock() # flock does not exclude threads of the same process
+    self.lockFile = None
+
+  def __enter__(self):
+    self.threadLock.acquire()
+    try:
+      self.lockFile = open(self.fileName, 'a+b')
+      if os.name == 'nt':
+        self.lockFile.seek(0)
+        msvcrt.locking(self.lockFile.fileno(), msvcrt.LK_LOCK, 1)
+      else:
+        fcntl.flock(self.lockFile.fileno(), fcntl.LOCK_EX)
+    except Exception:
+      if self.lockFile is not None:
+        self.lockFile.close()
+      self.threadLock.release()
+      raise
+    return self
+
+  def __exit__(self, *exc):
+    try:
+      if os.name == 'nt':
+        self.lockFile.seek(0)
+        msvcrt.locking(self.lockFile.fileno(), msvcrt.LK_UNLCK, 1)
+      else:
+        fcntl.flock(self.lockFile.fileno(), fcntl.LOCK_UN)
+    finally:
+      self.lockFile.close()
+      self.lockFile = None
+      self.threadLock.release()
+
+# returns (mtime, size, content hash) identifying a version of a file
+def fileState(fileName, content):
+  stat = os.stat(fileName)
+  return (stat.st_mtime_ns, stat.st_size, hashlib.sha256(content).hexdigest())
+
+# returns {accountName: lastEdited} of account lines
+def baseOf(lines):
+  base = {}
+  for line in lines:
+    fields = json.loads(line)
+    base[fields['accountName']] = fields['lastEdited']
+  return base
+
+# merges two versions of a vault's account lines into {accountName: line}.
+# base is {accountName: lastEdited} of the version both started from, it tells an account added
+# on one side from one deleted on the other. Accounts on both sides keep the more recently edited version
+def mergeLines(ours, theirs, base):
+  def byName(lines):
+    return {fields['accountName']: (fields['lastEdited'], line) for fields, line in ((json.loads(line), line) for line in lines)}
+  ours, theirs = byName(ours), byName(theirs)
+  merged = {}
+  for name in ours.keys() | theirs.keys():
+    mine, other = ours.get(name), theirs.get(name)
+    if mine and other:
+      newer = other if dt.fromisoformat(other[0]) > dt.fromisoformat(mine[0]) else mine
+      merged[name] = newer[1]
+    elif mine and base.get(name) != mine[0]:
+      # added or edited here, or not deleted there
+      merged[name] = mine[1]
+    elif other and base.get(name) != other[0]:
+      merged[name] = other[1]
+  return merged
+
+# flushes a rename in the containing directory to disk. Not supported on windows
+def syncDirectory(fileName):
+  if os.name == 'nt':
+    return
+  dirFd = os.open(os.path.dirname(os.path.abspath(fileName)), os.O_RDONLY)
+  try:
+    os.fsync(dirFd)
+  finally:
+    os.close(dirFd)
+
+### Write-behind saver
+# Encryption and file writing run on a worker thread so the UI does not block on save.
+# Only the latest submitted snapshot is kept: saves issued while a write is in flight are coalesced.
+# Each write goes to a temp file which is fsynced, then atomically renamed over the data file,
+# so a crash leaves either the old or the new vault, never a truncated one.
+# The previous encrypted files are kept as <file>.1 (newest) to <file>.N (oldest)
+# The saver also owns the file on disk: it remembers the version last read or written
+# and merges in changes made by other programs before writing
+class BackgroundSaver():
+  def __init__(self, fileName, backupGenerations=3):
+    self.fileName = fileName
+    self.backupGenerations = backupGenerations
+    self.lock = FileLock(fileName + '.lock')
+    self.fileState = None # fileState of the version last read or written, None if there was no file
+    self.base = {}        # {accountName: lastEdited} of that version
+    self.filePassword = None # password of that version, differs from the queued one after a password change
+    self.needsRefresh = False # set when the file holds changes not loaded into memory yet
+    self.condition = threading.Condition()
+    self.pending = None # (password, kdfParams, compression, lines, base) waiting to be written
+    self.writing = False
+    self.stopped = False
+    self.thread = None
+    self.afterWrite = None # called with the kdf parameters of every file written, while holding the lock
+    self.cachedKey = (None, None) # ((password, kdfParams), key), avoids re-deriving for every save
+
+  # queues account lines to be compressed, encrypted and written, replacing any queued snapshot
+  # base is {accountName: lastEdited} of the lines
+  def submit(self, password, kdfParams, compression, lines, base):
+    with self.condition:
+      self.pending = (password, kdfParams, compression, lines, base)
+      if self.thread is None:
+        self.thread = threading.Thread(target=self.work, name='pwm-saver', daemon=True)
+        self.thread.start()
+      self.condition.notify_all()
+
+  def work(self):
+    while True:
+      with self.condition:
+        while self.pending is None and not self.stopped:
+          self.condition.wait()
+        if self.pending is None:
+          return
+        password, kdfParams, compression, lines, base = self.pending
+        self.pending = None
+        self.writing = True
+      try:
+        self.write(password, kdfParams, compression, lines, base)
+      except Exception as e:
+        print(f'\nSaving to {self.fileName} failed: {e}')
+      finally:
+        with self.condition:
+          self.writing = False
+          self.condition.notify_all()
+
+  def getKey(self, password, kdfParams):
+    cacheKey = (password, json.dumps(kdfParams, sort_keys=True))
+    if self.cachedKey[0] != cacheKey:
+      self.cachedKey = (cacheKey, deriveKey(password, kdfParams))
+    return self.cachedKey[1]
+
+  # returns the file contents for the given lines
+  def encode(self, password, kdfParams, compression, lines):
+    encrypted = Fernet(self.getKey(password, kdfParams)).encrypt(packLines(lines, compression))
+    if compression is not None:
+      encrypted = urlsafe_b64decode(encrypted)
+    return vaultHeader(kdfParams, compression) + encrypted
+
+  def write(self, password, kdfParams, compression, lines, base):
+    content = self.encode(password, kdfParams, compression, lines)
+    with self.lock:
+      if self.checkChanged():
+        # the file on disk is still encrypted with the password it was last read or written with
+        _, theirs = self.readUnlocked(password if self.filePassword is None else self.filePassword)
+        merged = mergeLines(lines, theirs, self.base)
+        lines = [merged[name] for name in sorted(merged)]
+        # base stays that of the lines in memory, so the refresh drops accounts deleted there
+        content = self.encode(password, kdfParams, compression, lines)
+        self.needsRefresh = True
+      tempName = self.fileName + '.tmp'
+      with open(tempName, 'wb') as outputFile:
+        outputFile.write(content)
+        outputFile.flush()
+        os.fsync(outputFile.fileno())
+      self.rotateBackups()
+      os.replace(tempName, self.fileName)
+      if self.afterWrite is not None:
+        self.afterWrite(kdfParams)
+      syncDirectory(self.fileName)
+      self.fileState = fileState(self.fileName, content)
+      self.base = base
+      self.filePassword = password
+
+  # decrypts the file, returns its kdf parameters and account lines and remembers its version
+  def read(self, password):
+    with self.lock:
+      return self.readUnlocked(password)
+
+  def readUnlocked(self, password):
+    with open(self.fileName, 'rb') as inputFile:
+      content = inputFile.read()
+    kdfParams, compression, encrypted = parseVaultFile(content)
+    decrypted = Fernet(self.getKey(password, kdfParams)).decrypt(encrypted)
+    lines = [str(line, 'utf-8') + '\n' for line in unpackLines(decrypted, compression)]
+    self.fileState = fileState(self.fileName, content)
+    self.filePassword = password
+    return kdfParams, lines
+
+  # derives the key of the file from its header, so the next read finds it cached.
+  # Key derivation releases the GIL, unlike decoding the accounts, so several vaults can derive at once
+  def prepareKey(self, password):
+    with open(self.fileName, 'rb') as inputFile:
+      header = inputFile.readline()
+    kdfParams, _, _ = parseVaultFile(header)
+    self.getKey(password, kdfParams)
+
+  # true if another program wrote the file since it was last read or written here
+  def changedOnDisk(self):
+    with self.lock:
+      return self.checkChanged()
+
+  # only compares contents when mtime or size differ. Caller holds the lock
+  def checkChanged(self):
+    try:
+      stat = os.stat(self.fileName)
+    except FileNotFoundError:
+      return False
+    if self.fileState is None:
+      return True
+    if (stat.st_mtime_ns, stat.st_size) == self.fileState[:2]:
+      return False
+    with open(self.fileName, 'rb') as inputFile:
+      content = inputFile.read()
+    state = fileState(self.fileName, content)
+    if state[2] == self.fileState[2]:
+      self.fileState = state
+      return False
+    return True
+
+  # shifts <file>.1 .. <file>.N-1 up by one and copies the current file into <file>.1
+  def rotateBackups(self):
+    if self.backupGenerations < 1 or not os.path.exists(self.fileName):
+      return
+    for i in range(self.backupGenerations - 1, 0, -1):
+      older = f'{self.fileName}.{i}'
+      if os.path.exists(older):
+        os.replace(older, f'{self.fileName}.{i + 1}')
+    shutil.copyfile(self.fileName, f'{self.fileName}.1')
+
+  # blocks until every submitted snapshot has been written
+  def flush(self):
+    with self.condition:
+      while self.pending is not None or self.writing:
+        self.condition.wait()
+
+  # flushes and stops the worker thread. A later submit starts a new one
+  def close(self):
+    self.flush()
+    with self.condition:
+      self.stopped = True
+      self.condition.notify_all()
+    if self.thread is not None:
+      self.thread.join()
+    self.thread = None
+    self.stopped = False
+
+# returns the accumulation lists of the given accounts, without duplicates
+def collectLists(accounts):
+  lists = {'username': {}, 'email': {}, 'password': {}, 'phone': {}, 'linkedAccounts': {}}
+  for acc in accounts:
+    lists['username'][acc.username] = None
+    lists['email'][acc.email] = None
+    lists['password'][acc.password] = None
+    lists['phone'][acc.phone] = None
+    for la in acc.linkedAccounts:
+      lists['linkedAccounts'][la] = None
+    normalizeMisc(acc.misc)
+  return {k: list(v) for k, v in lists.items()}
+
+### Accounts kept sorted by accountName
+# Accounts are inserted and removed with bisect instead of re-sorting the whole list after every edit,
+# and prefix and range queries cost O(log n + k). names mirrors accounts for bisecting.
+# Names can repeat across vaults. An account whose name is changed has to be moved with rename
+class AccountList():
+  def __init__(self, accounts=[]):
+    self.accounts = sorted(accounts, key=lambda a: a.accountName)
+    self.names = [acc.accountName for acc in self.accounts]
+
+  def __iter__(self):
+    return iter(self.accounts)
+
+  def __len__(self):
+    return len(self.accounts)
+
+  def __getitem__(self, index):
+    return self.accounts[index]
+
+  def __contains__(self, account):
+    return self.indexOf(account) is not None
+
+  # returns the position of the account, None if not in the list.
+  # name is where to look for it, if the account was renamed since it was added
+  def indexOf(self, account, name=None):
+    if name is None:
+      name = account.accountName
+    for i in range(bisect_left(self.names, name), bisect_right(self.names, name)):
+      if self.accounts[i] is account:
+        return i
+    return None
+
+  def add(self, account):
+    i = bisect_right(self.names, account.accountName)
+    self.names.insert(i, account.accountName)
+    self.accounts.insert(i, account)
+
+  # adds many accounts at once, sorting once instead of inserting one by one
+  def extend(self, accounts):
+    self.accounts.extend(accounts)
+    self.accounts.sort(key=lambda a: a.accountName)
+    self.names = [acc.accountName for acc in self.accounts]
+
+  def remove(self, account, name=None):
+    i = self.indexOf(account, name)
+    if i is None:
+      raise ValueError(f'Account {account.accountName} is not in the list')
+    del self.names[i]
+    del self.accounts[i]
+
+  # moves an account to its place after its name was changed from oldName
+  def rename(self, account, oldName):
+    self.remove(account, oldName)
+    self.add(account)
+
+  def hasName(self, name):
+    i = bisect_left(self.names, name)
+    return i < len(self.names) and self.names[i] == name
+
+  # returns (start, end) positions of names with lowName <= accountName < highName,
+  # up to the end if highName is None
+  def span(self, lowName, highName=None):
+    start = bisect_left(self.names, lowName)
+    end = len(self.names) if highName is None else bisect_left(self.names, highName)
+    return start, max(start, end)
+
+  def prefixSpan(self, prefix):
+    if not prefix:
+      return 0, len(self.names)
+    return self.span(prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+  # returns the accounts with lowName <= accountName < highName
+  def between(self, lowName, highName=None):
+    start, end = self.span(lowName, highName)
+    return self.accounts[start:end]
+
+  # returns the accounts with names starting with prefix
+  def withPrefix(self, prefix):
+    start, end = self.prefixSpan(prefix)
+    return self.accounts[start:end]
+
+  def countPrefix(self, prefix):
+    start, end = self.prefixSpan(prefix)
+    return end - start
+
+### A single encrypted data file with its own master password
+class Vault():
+  def __init__(self, fileName, backupGenerations=3, compression='zlib'):
+    self.fileName = fileName
+    self.compression = compression # used for saving, files are read with the compression in their header
+    self.name = os.path.splitext(os.path.basename(fileName))[0]
+    self.masterPassword = ''
+    self.kdfParams = None # from the file header, None until loaded or first saved
+    self.saver = BackgroundSaver(fileName, backupGenerations)
+    self.history = History(fileName + '.history', self.getKey, self.saver.lock)
+    self.saver.afterWrite = self.written
+
+  def getKey(self):
+    return self.saver.getKey(self.masterPassword, self.kdfParams)
+
+  # switches to the configured kdf parameters with a new salt, and optionally a new password.
+  # The history is re-encrypted with the new key, and replaces the old one once the vault is written with it.
+  # The salt is new for every rekey, so it identifies the key.
+  # Raises InvalidToken and keeps the current key if the history cannot be read with it,
+  # a history that is not re-encrypted could never be read again
+  def rekey(self, password=None):
+    # snapshots queued with the old key have to be written first
+    self.saver.flush()
+    if self.kdfParams is not None:
+      self.history.load()
+    if password is not None:
+      self.masterPassword = password
+    self.kdfParams = saltKdf(loadKdfConfig())
+    self.history.rewrite(self.kdfParams['salt'])
+
+  # called by the saver thread after the vault file was replaced
+  def written(self, kdfParams):
+    self.history.commitRewrite(kdfParams['salt'])
+
+  # decrypts the file and returns its accounts, tagged with this vault
+  def load(self, password):
+    # decrypt file based on password, saved for encryption later
+    self.kdfParams, lines = self.saver.read(password)
+    self.masterPassword = password
+
+    accounts = []
+    for line in lines:
+      acc = Account(**json.loads(line, object_hook=DecodeDateTime))
+      acc.vault = self
+      accounts.append(acc)
+    self.saver.base = {acc.accountName: acc.lastEdited.isoformat() for acc in accounts}
+    self.history.recover()
+    self.history.baseline(accounts, lines)
+    return accounts
+
+  # records changes to the history and queues the given accounts to be written by the saver thread
+  # Legacy files and files made with other than the configured kdf parameters are re-keyed first
+  def save(self, accounts):
+    if needsRekey(self.kdfParams, loadKdfConfig()):
+      try:
+        self.rekey()
+      except InvalidToken:
+        print(f'\nCould not read {self.history.fileName}, {self.fileName} keeps its current key')
+    lines = [serializeAccount(acc) for acc in accounts]
+    base = {acc.accountName: acc.lastEdited.isoformat() for acc in accounts}
+    try:
+      self.history.record(accounts, lines)
+    except InvalidToken:
+      print(f'\nCould not read {self.history.fileName}, changes are saved without history')
+    self.saver.submit(self.masterPassword, self.kdfParams, self.compression, lines, base)
+
+### Database mounts one or more vaults. Accounts of every vault are kept together in accountList,
+# so searches cover all mounted vaults. Account.vault tells which file an account is saved to.
+# New accounts go to the default vault, the first one mounted
 class Database():
   def __init__(self, accountList=[], emailList=[], usernameList=[], passwordList=[], phoneList=[], linkedAccountsList=[]):
-    self.masterPassword = ''
-    self.accountList: type[list[Account]] = accountList
+    self.vaults: type[list[Vault]] = []
+    self.accountList: type[AccountList] = AccountList(accountList)
     self.usernameList = usernameList
     self.emailList = emailList
     self.passwordList = passwordList
     self.phoneList = phoneList
     self.linkedAccountsList = linkedAccountsList # entries will be the string in Account.accountName
+    self.index = SearchIndex() # full-text index, kept up to date by every method changing accounts
     self.DATA_FILE_NAME = 'accounts.data'
     # self.TEST_FILE_NAME = 'accounts.test'
+    self.BACKUP_GENERATIONS = 3
+    self.COMPRESSION = 'zlib' # 'zlib', 'lzma' or None, for vaults mounted afterwards
+    self.WATCH_INTERVAL = 5 # seconds between checks for changes made by other programs
+    self.watchStop = threading.Event()
+    self.watcher = None
+
+  # adds a vault file to be loaded by unlock, returns the Vault
+  def mount(self, fileName):
+    for vault in self.vaults:
+      if vault.fileName == fileName:
+        return vault
+    vault = Vault(fileName, self.BACKUP_GENERATIONS, self.COMPRESSION)
+    self.vaults.append(vault)
+    return vault
+
+  # vault new accounts are added to. Mounts DATA_FILE_NAME if nothing is mounted yet
+  def defaultVault(self):
+    if not self.vaults:
+      self.mount(self.DATA_FILE_NAME)
+    return self.vaults[0]
+
+  # master password of the default vault
+  @property
+  def masterPassword(self):
+    return self.defaultVault().masterPassword
 
-  # load data from some file in same directory
+  @masterPassword.setter
+  def masterPassword(self, password):
+    self.defaultVault().masterPassword = password
+
+  # load data from some file in same directory, using one password for all mounted vaults
   def load(self, password):
-    with open(self.DATA_FILE_NAME, 'rb') as inputFile:
-      encrypted = inputFile.read()
-      # Save input password for encryption later
-      self.masterPassword = password
-      # decrypt file based on self.masterPassword
-      kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=b'69420', iterations=69420)
-      key = urlsafe_b64encode(kdf.derive(bytes(self.masterPassword, 'utf-8')))
-      fernet = Fernet(key)
-      decrypted = fernet.decrypt(encrypted)
-
-      for line in decrypted.splitlines():
-        acc = Account(**json.loads(str(line, 'utf-8'), object_hook=DecodeDateTime))
-        self.accountList.append(acc)
-      self.updateLists()
+    self.defaultVault()
+    return self.unlock({vault.fileName: password for vault in self.vaults})
+
+  # given a dict of fileName: password, derives the keys of the vaults concurrently, then decrypts them.
+  # Only key derivation runs in threads: decoding accounts and indexing hold the GIL,
+  # and running them in threads was slower than one after another.
+  # Vaults that fail to unlock are unmounted, so they are never saved over with no accounts.
+  # Raises only if no vault could be unlocked, a missing file only if every file is missing
+  def unlock(self, passwords):
+    vaults = [self.mount(fileName) for fileName in passwords]
+    with ThreadPoolExecutor(max_workers=len(vaults)) as executor:
+      # failures happen again in load below, which reports them
+      for vault in vaults:
+        executor.submit(vault.saver.prepareKey, passwords[vault.fileName])
+
+    results = []
+    failed = {}
+    for vault in vaults:
+      try:
+        accounts = vault.load(passwords[vault.fileName])
+        results.append((accounts, collectLists(accounts)))
+      except Exception as e:
+        failed[vault] = e
+
+    if not results:
+      errors = list(failed.values())
+      raise next((e for e in errors if not isinstance(e, FileNotFoundError)), errors[0])
+    for vault, e in failed.items():
+      reason = 'invalid password' if isinstance(e, InvalidToken) else 'file does not exist' if isinstance(e, FileNotFoundError) else e
+      print(f'Could not unlock {vault.fileName} ({reason}), it is not mounted')
+      self.vaults.remove(vault)
+
+    for accounts, _ in results:
+      self.accountList.extend(accounts)
+    self.setLists([lists for _, lists in results])
+    self.index.build(self.accountList)
     return self
 
   # save data to file
-  def save(self):
-    self.sortAlphaNumeric()
+  # serializes a snapshot here, encryption and writing happen on the saver thread
+  # if vault is given, only that vault is written
+  # changes other programs made to the vault files are merged in first
+  def save(self, vault=None):
+    vaults = self.vaults if vault is None else [vault]
+    for v in vaults:
+      if v.saver.needsRefresh or v.saver.changedOnDisk():
+        self.refresh(v)
     self.updateLists()
-    with open(self.DATA_FILE_NAME, 'wb') as outputFile:
-    # with open(self.TEST_FILE_NAME, 'wb') as outputFile:
-      json_string = ''
-      for acc in self.accountList:
-        json_string += json.dumps(acc.__dict__, cls=DateTimeEncoder) + '\n'
-
-      # encrypt based on self.masterPassword 
-      kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=b'69420', iterations=69420)
-      key = urlsafe_b64encode(kdf.derive(bytes(self.masterPassword, 'utf-8')))
-      fernet = Fernet(key)
-      
-      encrypted = fernet.encrypt(bytes(json_string, 'ascii'))
-      outputFile.write(encrypted)
-      # outputFile.write(json_string.encode('utf-8'))
+    for v in vaults:
+      v.save([acc for acc in self.accountList if acc.vault is v])
+
+  # merges the vault file into memory after another program changed it. Accounts edited on both sides
+  # keep the more recent edit, accounts added or deleted on either side are added or deleted here.
+  # Returns whether the changes were merged, False if the file could not be read
+  def refresh(self, vault):
+    # a write still in flight would otherwise overwrite the version read here with an older snapshot
+    vault.saver.flush()
+    vault.saver.needsRefresh = False
+    try:
+      # the other program may have re-keyed the file, and its history with it
+      vault.kdfParams, theirs = vault.saver.read(vault.masterPassword)
+    except InvalidToken:
+      print(f'Could not read changes to {vault.fileName}, it was encrypted with another password')
+      return False
+    vault.history.lineages = None
+    ours = {acc.accountName: acc for acc in self.accountList if acc.vault is vault}
+    ourLines = {name: serializeAccount(acc) for name, acc in ours.items()}
+    merged = mergeLines(ourLines.values(), theirs, vault.saver.base)
+    for name, line in merged.items():
+      acc = ours.pop(name, None)
+      if acc is None:
+        acc = Account(**json.loads(line, object_hook=DecodeDateTime))
+        acc.vault = vault
+        self.accountList.add(acc)
+        self.index.update(acc)
+        vault.history.baseline([acc], [line])
+      elif line != ourLines[name]:
+        for k, v in json.loads(line, object_hook=DecodeDateTime).items():
+          setattr(acc, k, v)
+        normalizeMisc(acc.misc)
+        self.index.update(acc)
+        vault.history.baseline([acc], [line])
+    for acc in ours.values():
+      self.accountList.remove(acc)
+      self.index.remove(acc)
+      vault.history.forget(acc)
+    vault.saver.base = baseOf(theirs)
+    self.updateLists()
+    return True
+
+  # refreshes vaults the watcher found changed, returns the names of the vaults whose changes were merged
+  def refreshChanged(self):
+    refreshed = []
+    for vault in self.vaults:
+      if vault.saver.needsRefresh and self.refresh(vault):
+        refreshed.append(vault.name)
+    return refreshed
+
+  # starts a thread checking the vault files for changes by other programs every WATCH_INTERVAL seconds.
+  # It only flags changed vaults, refreshChanged loads the changes
+  def watch(self):
+    if self.watcher is not None:
+      return
+    def outputfunc():
+      while not self.watchStop.wait(self.WATCH_INTERVAL):
+        for vault in list(self.vaults):
+          if vault.saver.changedOnDisk():
+            vault.saver.needsRefresh = True
+    self.watchStop.clear()
+    self.watcher = threading.Thread(target=outputfunc, name='pwm-watcher', daemon=True)
+    self.watcher.start()
+
+  # blocks until pending saves are on disk
+  def flush(self):
+    for vault in self.vaults:
+      vault.saver.flush()
+
+  # flushes pending saves and stops the saver and watcher threads, call before exiting
+  def close(self):
+    if self.watcher is not None:
+      self.watchStop.set()
+      self.watcher.join()
+      self.watcher = None
+    for vault in self.vaults:
+      vault.saver.close()
 
   # returns number of accounts in data
   def numAccounts(self):
     return len(self.accountList)
 
-  # util function for internal account list sorting
-  def sortAlphaNumeric(self, reverse=False):
-    self.accountList.sort(key=lambda a: a.accountName, reverse=reverse)
-
   # returns a list of Accounts containing keyword. 
   # If keyword is a single letter, checks only for first letter
   # If keyword is blank, return all. Can return empty list.
   def filterAccountsByAccountName(self, keyword): 
     if len(keyword) == 1:
-      filteredList = filter(lambda account: keyword == account.accountName[0], self.accountList)
+      return self.accountList.withPrefix(keyword)
     else:
       filteredList = filter(lambda account: keyword in account.accountName, self.accountList)
     return list(filteredList)
 
+  # returns a list of Accounts with names starting with the letter, in either case.
+  # '#' returns the accounts starting with anything but a letter from A to Z
+  def filterAccountsByLetter(self, letter):
+    if letter == '#':
+      return self.accountList.between('', 'A') + self.accountList.between('[', 'a') + self.accountList.between('{')
+    return self.accountList.withPrefix(letter.upper()) + self.accountList.withPrefix(letter.lower())
+
+  # returns the number of accounts filterAccountsByLetter would return, without building the list
+  def countAccountsByLetter(self, letter):
+    if letter == '#':
+      return len(self.accountList) - sum(self.countAccountsByLetter(chr(c)) for c in range(ord('A'), ord('Z') + 1))
+    return self.accountList.countPrefix(letter.upper()) + self.accountList.countPrefix(letter.lower())
+
+  # returns a list of Accounts whose misc fields or other attributes match the query, see pwmindex
+  def searchEverything(self, query):
+    return self.index.search(query, self.accountList)
+
   # returns a list of Accounts using given email, assuming it exists
   def filterAccountsByEmail(self, email):
     return list(filter(lambda a: a.email == email, self.accountList))
@@ -125,25 +841,26 @@ class Database():
   # adds a given account with a non-empty accountName to the database, and returns it
   def addAccount(self, account: type[Account]):
     if not account.accountName == '':
-      self.accountList.append(account)
-      self.save()
+      if account.vault is None:
+        account.vault = self.defaultVault()
+      self.accountList.add(account)
+      self.index.update(account)
+      self.save(account.vault)
     return account
 
   # given an Account, delete it from the database
   def deleteAccount(self, account: type[Account]):
     accountName = copy(account.accountName)
     # search for account in the actual list
-    for acc in self.accountList:
-      if acc == account:
-        self.accountList.remove(acc)
-        del acc
-        print(f'Account for {accountName} deleted')
-        break
-    self.save()
+    if account in self.accountList:
+      self.accountList.remove(account)
+      self.index.remove(account)
+      print(f'Account for {accountName} deleted')
+    self.save(account.vault)
 
   # check if account name exists
   def checkAccountNameExists(self, name):
-    return name in [acc.accountName for acc in self.accountList]
+    return self.accountList.hasName(name)
 
   # given an Account, returns Account edited
   def editAccountName(self, account: type[Account], text):
@@ -153,40 +870,53 @@ class Database():
     if not self.checkAccountNameExists(text):
       oldName, account.accountName = account.accountName, text
       account.lastEdited = dt.now()
-      self.accountList
-      self.updateAllLinkedAccountInstances(oldName, text)
-      self.save()
+      self.accountList.rename(account, oldName)
+      self.index.update(account)
+      vaults = [account.vault]
+      vaults += [v for v in self.updateAllLinkedAccountInstances(oldName, text) if v not in vaults]
+      # only vaults with changes are written, every write rotates the vault's backups
+      for vault in vaults:
+        self.save(vault)
     else:
       print(f'Input name {text} already exists')
     return account
   
+  # returns the vaults of the accounts whose linkedAccounts changed
   def updateAllLinkedAccountInstances(self, oldName, newName):
+    vaults = []
     for acc in self.accountList:
       if oldName in acc.linkedAccounts:
         # print(f'linkedAccount found in {acc.accountName}: {acc.linkedAccounts}')
         newAccounts = list(map(lambda la: newName if la == oldName else la, acc.linkedAccounts))
         acc.linkedAccounts = newAccounts
         acc.lastEdited = dt.now()
+        self.index.update(acc)
+        if acc.vault not in vaults:
+          vaults.append(acc.vault)
+    return vaults
     
   # given an Account, returns Account edited
   def editUsername(self, account: type[Account], text):
     account.username = text
     account.lastEdited = dt.now()
-    self.save()
+    self.index.update(account)
+    self.save(account.vault)
     return account
 
   # given an Account, returns Account edited
   def editEmail(self, account: type[Account], text):
     account.email = text
     account.lastEdited = dt.now()
-    self.save()
+    self.index.update(account)
+    self.save(account.vault)
     return account
 
   # given an Account, returns Account edited
   def editPassword(self, account: type[Account], text):
     account.password = text
     account.lastEdited = dt.now()
-    self.save()
+    self.index.update(account)
+    self.save(account.vault)
     return account
 
   # given an Account, returns Account edited
@@ -198,7 +928,8 @@ class Database():
       return account
     account.phone = text
     account.lastEdited = dt.now()
-    self.save()
+    self.index.update(account)
+    self.save(account.vault)
     return account
     
   # given an Account, returns Account edited
@@ -209,12 +940,13 @@ class Database():
       account.linkedAccounts.remove(text)
     else:
       # check that account exists:
-      if text not in [acc.accountName for acc in self.accountList]:
+      if not self.accountList.hasName(text):
         print(f'Account to be linked does not exist yet. Create it first.')
         return account
       account.linkedAccounts.append(text)
       account.lastEdited = dt.now()
-    self.save()
+    self.index.update(account)
+    self.save(account.vault)
     return account
 
   # given an account, update the miscList field. Deletes key-value pair if 'value' is empty
@@ -224,7 +956,8 @@ class Database():
     else:
       account.misc[field] = value
     account.lastEdited = dt.now()
-    self.save()
+    self.index.update(account)
+    self.save(account.vault)
     return account
 
   # given a text, check if is of phone format:
@@ -237,32 +970,95 @@ class Database():
 
   # updates accumulation lists
   def updateLists(self):
-    # clear lists
-    self.usernameList = []
-    self.emailList = []
-    self.passwordList = []
-    self.phoneList = []
-    self.linkedAccountsList = []
+    self.setLists([collectLists(self.accountList)])
 
-    for acc in self.accountList:
-      if acc.username not in self.usernameList:
-        self.usernameList.append(acc.username)
-      if acc.email not in self.emailList:
-        self.emailList.append(acc.email)
-      if acc.password not in self.passwordList:
-        self.passwordList.append(acc.password)
-      if acc.phone not in self.phoneList:
-        self.phoneList.append(acc.phone)
-      for la in acc.linkedAccounts:
-        if la not in self.linkedAccountsList:
-          self.linkedAccountsList.append(la)
-      
-      # converts from previous data implementation where mutli-line misc items are in lists
-      for k,v in acc.misc.items():
-        if isinstance(v, list):
-          nlValue = "".join(v)
-          acc.misc[k] = nlValue
+  # merges accumulation lists from collectLists into the database lists
+  def setLists(self, listsPerVault):
+    merged = lambda key: list(dict.fromkeys(x for lists in listsPerVault for x in lists[key]))
+    self.usernameList = merged('username')
+    self.emailList = merged('email')
+    self.passwordList = merged('password')
+    self.phoneList = merged('phone')
+    self.linkedAccountsList = merged('linkedAccounts')
 
+  # changes the master password of the default vault, re-encrypting its history. Returns whether it changed.
+  # Changes other programs made are merged first, with the current password. If that fails nothing is changed
   def updateMasterPassword(self, password):
-    self.masterPassword = password
-    self.save()
+    vault = self.defaultVault()
+    if vault.saver.needsRefresh or vault.saver.changedOnDisk():
+      if not self.refresh(vault):
+        print('The master password is not changed')
+        return False
+    try:
+      vault.rekey(password)
+    except InvalidToken:
+      print(f'Could not read {vault.history.fileName}, the master password is not changed')
+      return False
+    # not self.save, refreshing with the new password would fail. Later outside changes are merged by the saver
+    self.updateLists()
+    vault.save([acc for acc in self.accountList if acc.vault is vault])
+    return True
+
+  # copies restored fields onto an account. The restore counts as a new edit.
+  # A restored name is updated in the accounts linking to the account, returns the vaults changed
+  def applyFields(self, account, fields):
+    oldName = account.accountName
+    for k, v in json.loads(json.dumps(fields), object_hook=DecodeDateTime).items():
+      setattr(account, k, v)
+    normalizeMisc(account.misc)
+    account.lastEdited = dt.now()
+    vaults = [account.vault]
+    if account.accountName != oldName:
+      self.accountList.rename(account, oldName)
+      vaults += [v for v in self.updateAllLinkedAccountInstances(oldName, account.accountName) if v not in vaults]
+    self.index.update(account)
+    return vaults
+
+  # given an Account, restores it to how it was at the given time. Returns the account
+  def restoreAccount(self, account: type[Account], time):
+    try:
+      fields = account.vault.history.accountAt(account, time)
+    except InvalidToken:
+      print(f'Could not read {account.vault.history.fileName}')
+      return account
+    if fields is None:
+      print(f'Account {account.accountName} did not exist at {time}')
+      return account
+    if fields['accountName'] != account.accountName and self.checkAccountNameExists(fields['accountName']):
+      print(f'Cannot restore, name {fields["accountName"]} is used by another account')
+      return account
+    for vault in self.applyFields(account, fields):
+      self.save(vault)
+    return account
+
+  # restores every account of a vault (default vault if not given) to how it was at the given time.
+  # Accounts without history have not changed and are kept as is
+  def restoreVault(self, time, vault=None):
+    if vault is None:
+      vault = self.defaultVault()
+    history = vault.history
+    try:
+      states = history.vaultAt(time)
+    except InvalidToken:
+      print(f'Could not read {history.fileName}')
+      return
+    vaults = [vault]
+    for acc in [acc for acc in self.accountList if acc.vault is vault]:
+      lineage = history.lineageFor(acc)
+      if lineage is None:
+        continue
+      if lineage in states:
+        vaults += [v for v in self.applyFields(acc, states.pop(lineage)) if v not in vaults]
+      else:
+        self.accountList.remove(acc)
+        self.index.remove(acc)
+    # accounts deleted since then
+    for lineage, fields in states.items():
+      acc = Account(**json.loads(json.dumps(fields), object_hook=DecodeDateTime))
+      acc.lastEdited = dt.now()
+      acc.vault = vault
+      history.adopt(acc, lineage)
+      self.accountList.add(acc)
+      self.index.update(acc)
+    for v in vaults:
+      self.save(v)
@@ -0,0 +1,278 @@
+import json
+import os
+from bisect import bisect_right
+from datetime import datetime as dt
+from cryptography.fernet import Fernet, InvalidToken
+
+### Edit history of a vault, stored next to it as <vault file>.history
+# Every line is a separately encrypted record, so new records are appended without rewriting the file
+# and the history grows with the size of the edits, not the size of the vault.
+# Records belong to a lineage, which is the life of one account across renames:
+#   'key'    - full snapshot of the account (keyframe)
+#   'delta'  - only the fields that changed
+#   'delete' - the account was removed
+# A keyframe is written every KEYFRAME_INTERVAL records of a lineage,
+# so restoring an account replays at most KEYFRAME_INTERVAL deltas
+# When the vault key changes, the history is re-encrypted into <vault file>.history.rekey, which only
+# replaces the history once the vault written with the new key is on disk. Until then new records go there too
+
+class History():
+  KEYFRAME_INTERVAL = 16
+
+  def __init__(self, fileName, getKey, lock):
+    self.fileName = fileName
+    self.getKey = getKey # returns the fernet key of the vault
+    self.lock = lock     # shared with the vault file, other programs may append to the history too
+    self.size = 0        # file size after the last read or append here
+    self.lineages = None # lineage id: list of records, read from file on first use
+    self.times = {}      # lineage id: list of record times, for bisecting
+    self.names = {}      # account name: lineage id, for accounts that currently exist
+    self.lineageNames = {} # lineage id: account name, reverse of names
+    self.nextLineage = 0
+    self.tracked = {}    # id(Account): [lineage id or None, last saved line, Account]
+    self.rekeyName = fileName + '.rekey'
+    self.rewriteVersion = None # set by rewrite until commitRewrite, while records go to rekeyName
+
+  # remembers the state accounts were loaded in, so the first edit of an account
+  # without history can keyframe its previous state
+  def baseline(self, accounts, lines):
+    for acc, line in zip(accounts, lines):
+      self.tracked[id(acc)] = [None, line, acc]
+
+  # stops tracking an account removed from memory without being deleted
+  def forget(self, account):
+    self.tracked.pop(id(account), None)
+
+  # reads and decrypts the history file into memory.
+  # Only the last record may fail to decrypt, being torn by a crash during append. Raises InvalidToken
+  # for any other, so a history made with another key is not mistaken for an empty one
+  def load(self):
+    if self.lineages is not None:
+      return
+    self.lineages = {}
+    self.times = {}
+    self.names = {}
+    self.lineageNames = {}
+    self.nextLineage = 0
+    if not os.path.exists(self.fileName):
+      return
+    fernet = Fernet(self.getKey())
+    try:
+      with open(self.fileName, 'rb') as inputFile:
+        self.size = os.fstat(inputFile.fileno()).st_size
+        torn = None
+        for line in inputFile:
+          if torn is not None:
+            raise torn
+          try:
+            record = json.loads(fernet.decrypt(line.strip()))
+          except InvalidToken as e:
+            torn = e
+            continue
+          record['time'] = dt.fromisoformat(record['time'])
+          self.index(record)
+    except Exception:
+      self.lineages = None
+      raise
+
+  # adds a record to the in-memory history
+  def index(self, record):
+    lineage = record['lineage']
+    self.nextLineage = max(self.nextLineage, lineage + 1)
+    self.lineages.setdefault(lineage, []).append(record)
+    self.times.setdefault(lineage, []).append(record['time'])
+    name = record['fields'].get('accountName')
+    if record['kind'] == 'delete' or name is not None:
+      oldName = self.lineageNames.pop(lineage, None)
+      if self.names.get(oldName) == lineage:
+        del self.names[oldName]
+    if record['kind'] != 'delete' and name is not None:
+      self.names[name] = lineage
+      self.lineageNames[lineage] = name
+
+  # writes records to the end of the history file
+  def append(self, records):
+    if not records:
+      return
+    fernet = Fernet(self.getKey())
+    with open(self.fileName if self.rewriteVersion is None else self.rekeyName, 'a+b') as outputFile:
+      self.dropTornRecord(outputFile)
+      for record in records:
+        line = json.dumps({**record, 'time': record['time'].isoformat()})
+        outputFile.write(fernet.encrypt(bytes(line, 'utf-8')) + b'\n')
+      self.size = outputFile.tell()
+    for record in records:
+      self.index(record)
+
+  # cuts off a record left unfinished by a crash, so the next record starts on its own line.
+  # Appends happen while holding the lock, so an unfinished record cannot be one still being written
+  def dropTornRecord(self, outputFile):
+    end = outputFile.seek(0, os.SEEK_END)
+    cut = 0
+    position = end
+    while position > 0:
+      start = max(0, position - 4096)
+      outputFile.seek(start)
+      newline = outputFile.read(position - start).rfind(b'\n')
+      if newline >= 0:
+        cut = start + newline + 1
+        break
+      position = start
+    if cut < end:
+      outputFile.truncate(cut)
+
+  # re-encrypts the whole history with the current key into rekeyName, used after a master password change.
+  # load() has to be called while the old key is still in place.
+  # version identifies the new key, commitRewrite is called with it once the vault using that key is written
+  def rewrite(self, version):
+    if self.lineages is None and not os.path.exists(self.fileName):
+      return
+    self.load()
+    records = sorted((r for rs in self.lineages.values() for r in rs), key=lambda r: r['time'])
+    fernet = Fernet(self.getKey())
+    with self.lock:
+      with open(self.rekeyName, 'wb') as outputFile:
+        for record in records:
+          line = json.dumps({**record, 'time': record['time'].isoformat()})
+          outputFile.write(fernet.encrypt(bytes(line, 'utf-8')) + b'\n')
+        outputFile.flush()
+        os.fsync(outputFile.fileno())
+      self.rewriteVersion = version
+
+  # replaces the history with the re-encrypted one if the vault was written with its key.
+  # Called by the saver right after replacing the vault file, holding the lock
+  def commitRewrite(self, version):
+    if self.rewriteVersion is None or self.rewriteVersion != version:
+      return
+    os.replace(self.rekeyName, self.fileName)
+    self.size = os.path.getsize(self.fileName)
+    self.rewriteVersion = None
+
+  # finishes or discards a re-encryption interrupted by a crash, call after loading the vault.
+  # A leftover rekeyName opening with the current key belongs to the vault on disk
+  def recover(self):
+    with self.lock:
+      if self.rewriteVersion is not None or not os.path.exists(self.rekeyName):
+        return
+      with open(self.rekeyName, 'rb') as inputFile:
+        first = inputFile.readline().strip()
+      try:
+        Fernet(self.getKey()).decrypt(first)
+      except InvalidToken:
+        os.remove(self.rekeyName)
+        return
+      os.replace(self.rekeyName, self.fileName)
+      self.lineages = None
+
+  # returns an unused lineage id
+  def newLineage(self):
+    lineage = self.nextLineage
+    self.nextLineage += 1
+    return lineage
+
+  # returns the lineage of a loaded account, None if it has no history
+  def lineageFor(self, account):
+    self.load()
+    entry = self.tracked.get(id(account))
+    if entry is None:
+      return None
+    if entry[0] is None:
+      entry[0] = self.names.get(json.loads(entry[1])['accountName'])
+    return entry[0]
+
+  # makes a newly created account continue an existing lineage, used when restoring deleted accounts
+  def adopt(self, account, lineage):
+    self.tracked[id(account)] = [lineage, None, account]
+
+  # returns the lineage of a tracked account, starting one with a keyframe of its
+  # previously saved state if the account has no history yet
+  def lineageOf(self, entry, records):
+    if entry[0] is None:
+      old = json.loads(entry[1])
+      lineage = self.names.get(old['accountName'])
+      if lineage is None:
+        lineage = self.newLineage()
+        records.append({'time': dt.fromisoformat(old['lastEdited']), 'lineage': lineage, 'kind': 'key', 'fields': old})
+      entry[0] = lineage
+    return entry[0]
+
+  # number of records in a lineage since its last keyframe.
+  # A lineage gets at most one pending record besides a fresh keyframe, so those are not counted
+  def sinceKeyframe(self, lineage):
+    count = 0
+    for record in reversed(self.lineages.get(lineage, [])):
+      if record['kind'] == 'key':
+        return count
+      count += 1
+    return count
+
+  # compares the accounts of the vault with their last saved lines and appends
+  # a keyframe, delta or delete record for every account that changed
+  def record(self, accounts, lines):
+    with self.lock:
+      # another program appended since the last read, reload so lineage ids do not collide
+      if self.lineages is not None and self.rewriteVersion is None and \
+        os.path.exists(self.fileName) and os.path.getsize(self.fileName) != self.size:
+        self.lineages = None
+      self.recordUnlocked(accounts, lines)
+
+  def recordUnlocked(self, accounts, lines):
+    self.load()
+    now = dt.now()
+    records = []
+    seen = set()
+    for acc, line in zip(accounts, lines):
+      seen.add(id(acc))
+      entry = self.tracked.get(id(acc))
+      if entry is None:
+        # new account
+        lineage = self.newLineage()
+        records.append({'time': now, 'lineage': lineage, 'kind': 'key', 'fields': json.loads(line)})
+        self.tracked[id(acc)] = [lineage, line, acc]
+      elif entry[1] != line:
+        lineage = self.lineageOf(entry, records)
+        old, new = json.loads(entry[1] or '{}'), json.loads(line)
+        if entry[1] is None or self.sinceKeyframe(lineage) >= self.KEYFRAME_INTERVAL - 1:
+          records.append({'time': now, 'lineage': lineage, 'kind': 'key', 'fields': new})
+        else:
+          delta = {k: v for k, v in new.items() if old.get(k) != v}
+          records.append({'time': now, 'lineage': lineage, 'kind': 'delta', 'fields': delta})
+        entry[1] = line
+    for key in [key for key in self.tracked if key not in seen]:
+      lineage = self.lineageOf(self.tracked.pop(key), records)
+      records.append({'time': now, 'lineage': lineage, 'kind': 'delete', 'fields': {}})
+    self.append(records)
+
+  # returns the fields of a lineage as they were at the given time,
+  # None if the account did not exist then
+  def stateAt(self, lineage, time):
+    records = self.lineages.get(lineage, [])
+    last = bisect_right(self.times.get(lineage, []), time) - 1
+    if last < 0 or records[last]['kind'] == 'delete':
+      return None
+    first = last
+    while records[first]['kind'] != 'key':
+      first -= 1
+    fields = {}
+    for record in records[first:last + 1]:
+      fields.update(record['fields'])
+    return fields
+
+  # returns the fields of a loaded account at the given time.
+  # Accounts without history have not changed since they were loaded, None if the account did not exist then
+  def accountAt(self, account, time):
+    lineage = self.lineageFor(account)
+    if lineage is None:
+      entry = self.tracked.get(id(account))
+      return json.loads(entry[1]) if entry else None
+    return self.stateAt(lineage, time)
+
+  # returns {lineage: fields} for every account with history that existed at the given time
+  def vaultAt(self, time):
+    self.load()
+    states = {}
+    for lineage in self.lineages:
+      fields = self.stateAt(lineage, time)
+      if fields is not None:
+        states[lineage] = fields
+    return states
@@ -0,0 +1,150 @@
+import re
+from bisect import bisect_left, bisect_right
+
+### Full-text inverted index over accounts
+# Every misc key and value (and the other fields in INDEXED_FIELDS, if indexAllFields) is split into
+# lowercase word tokens. Each token has a posting list of the accounts containing it.
+# Queries are words separated by spaces, all of which must match (AND).
+# 'OR' between groups of words matches either group, and a word ending in '*' matches as a prefix:
+#   recovery code OR backup*
+# Passwords are not indexed, there is a separate search for them
+# Prefix queries use pairTokens and pairIds, every (token, account) pair sorted by token in two parallel lists,
+# so the accounts of all tokens with a prefix are one slice instead of a union of many small postings.
+# One letter prefixes match the most, their accounts are kept in initials
+
+TOKEN_PATTERN = re.compile(r'\w+')
+INDEXED_FIELDS = ['accountName', 'username', 'email', 'phone', 'linkedAccounts']
+
+def tokenize(text):
+  return TOKEN_PATTERN.findall(text.lower())
+
+class SearchIndex():
+  def __init__(self, indexAllFields=True):
+    self.indexAllFields = indexAllFields
+    self.postings = {}   # token: set of id(Account)
+    self.pairTokens = [] # token of every posting entry, sorted
+    self.pairIds = []    # id(Account) of every posting entry, in the order of pairTokens
+    self.initials = {}   # first character: set of id(Account) with a token starting with it
+    self.docTokens = {}  # id(Account): set of tokens, to update postings on edit
+    self.accounts = {}   # id(Account): Account
+
+  # returns the set of tokens of an account
+  def accountTokens(self, account):
+    texts = []
+    for k, v in account.misc.items():
+      texts.append(k)
+      # multi-line values of old data files are lists of lines
+      texts.append(''.join(v) if isinstance(v, list) else v)
+    if self.indexAllFields:
+      for field in INDEXED_FIELDS:
+        value = getattr(account, field)
+        texts.extend(value if isinstance(value, list) else [value])
+    return set(tokenize(' '.join(texts)))
+
+  # rebuilds the index from scratch, sorting the vocabulary once
+  def build(self, accounts):
+    self.postings = {}
+    self.pairTokens = []
+    self.pairIds = []
+    self.initials = {}
+    self.docTokens = {}
+    self.accounts = {}
+    for acc in accounts:
+      tokens = self.accountTokens(acc)
+      self.docTokens[id(acc)] = tokens
+      self.accounts[id(acc)] = acc
+      for token in tokens:
+        posting = self.postings.get(token)
+        if posting is None:
+          self.postings[token] = {id(acc)}
+        else:
+          posting.add(id(acc))
+    for token in sorted(self.postings):
+      posting = self.postings[token]
+      self.pairTokens.extend([token] * len(posting))
+      self.pairIds.extend(posting)
+      self.initials.setdefault(token[0], set()).update(posting)
+
+  # adds an account, or re-indexes it after an edit
+  def update(self, account):
+    old = self.docTokens.get(id(account), set())
+    new = self.accountTokens(account)
+    for token in old - new:
+      self.removePosting(token, id(account))
+    for token in new - old:
+      self.postings.setdefault(token, set()).add(id(account))
+      i = bisect_right(self.pairTokens, token)
+      self.pairTokens.insert(i, token)
+      self.pairIds.insert(i, id(account))
+    self.updateInitials(id(account), old, new)
+    self.docTokens[id(account)] = new
+    self.accounts[id(account)] = account
+
+  def remove(self, account):
+    old = self.docTokens.pop(id(account), set())
+    for token in old:
+      self.removePosting(token, id(account))
+    self.updateInitials(id(account), old, set())
+    self.accounts.pop(id(account), None)
+
+  def updateInitials(self, docId, oldTokens, newTokens):
+    old, new = {token[0] for token in oldTokens}, {token[0] for token in newTokens}
+    for initial in old - new:
+      self.initials[initial].discard(docId)
+      if not self.initials[initial]:
+        del self.initials[initial]
+    for initial in new - old:
+      self.initials.setdefault(initial, set()).add(docId)
+
+  def removePosting(self, token, docId):
+    posting = self.postings[token]
+    posting.discard(docId)
+    if not posting:
+      del self.postings[token]
+    start = bisect_left(self.pairTokens, token)
+    i = self.pairIds.index(docId, start, bisect_right(self.pairTokens, token, start))
+    del self.pairTokens[i]
+    del self.pairIds[i]
+
+  # returns the set of ids of accounts matching one query word.
+  # candidates are the ids matching the other words so far, a prefix matching far more
+  # postings than that checks the tokens of the candidates instead
+  def matchWord(self, word, candidates=None):
+    if word.endswith('*'):
+      prefix = word[:-1].lower()
+      if not prefix:
+        return set(self.accounts)
+      if len(prefix) == 1:
+        return set(self.initials.get(prefix, ()))
+      start = bisect_left(self.pairTokens, prefix)
+      end = bisect_left(self.pairTokens, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+      if candidates is not None and len(candidates) * 16 < end - start:
+        return {docId for docId in candidates if any(token.startswith(prefix) for token in self.docTokens[docId])}
+      return set(self.pairIds[start:end])
+    # a word like an email address is several tokens, all of which must match
+    postings = [self.postings.get(token, set()) for token in tokenize(word)]
+    if not postings:
+      return set()
+    postings.sort(key=len)
+    return set(postings[0]).intersection(*postings[1:])
+
+  # returns the accounts matching the query, sorted by account name.
+  # ordered is all indexed accounts already sorted, filtering it is faster than sorting large results
+  def search(self, query, ordered=None):
+    docIds = set()
+    for group in re.split(r'\s+OR\s+', query.strip()):
+      # exact words first, they are cheap and narrow down the candidates for prefixes
+      words = sorted(group.split(), key=lambda word: word.endswith('*'))
+      if not words:
+        continue
+      matches = None
+      for word in words:
+        matches = self.matchWord(word) if matches is None else matches & self.matchWord(word, matches)
+        if not matches:
+          break
+      docIds |= matches
+    if ordered is not None and len(docIds) == len(self.accounts):
+      return list(ordered)
+    if ordered is not None and len(docIds) * 16 > len(self.accounts):
+      return [acc for acc in ordered if id(acc) in docIds]
+    return sorted((self.accounts[docId] for docId in docIds), key=lambda a: a.accountName)